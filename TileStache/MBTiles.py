@@ -13,6 +13,9 @@ Read the spec:
 MBTiles files generated by other applications such as Tilemill or Arc2Earth
 can be used as data sources for the MBTiles Provider.
 
+If the apsw package (https://github.com/rogerbinns/apsw) is installed, it's
+used to read and write tilesets in place of Python's standard sqlite3 module.
+
 Example configuration:
 
   {
@@ -35,14 +38,228 @@ MBTiles provider parameters:
   tileset:
     Required local file path to MBTiles tileset file, a SQLite 3 database file.
 """
-from .py3_compat import urlparse, urljoin
+from .py3_compat import urlparse, urljoin, Queue, Empty
+from .Core import KnownUnknown
 from os.path import exists
+from threading import local, Lock, Thread
+from itertools import islice
+from math import atan, sinh, pi, degrees
+import logging
+import atexit
+
+try:
+    # apsw is a thinner wrapper around SQLite than sqlite3, and is used if present.
+    import apsw
+except ImportError:
+    apsw = None
 
 # Heroku is missing standard python's sqlite3 package, so this will ImportError.
 from sqlite3 import connect as _connect
 
 from ModestMaps.Core import Coordinate
 
+try:
+    # Python 2 binds str as TEXT, so tile data must be wrapped to be a BLOB.
+    _blob = buffer
+except NameError:
+    # Python 3 binds any buffer-protocol object as a BLOB without copying it.
+    _blob = memoryview
+
+# Each thread keeps its own read-only connection per tileset, because a
+# sqlite3 connection can't safely be shared between threads. Writes all go
+# through one connection per tileset, serialized by a single lock.
+_pool = local()
+_writers = {}
+_write_lock = Lock()
+
+# Tile queries are kept as constant strings so that each connection's
+# statement cache finds them already prepared after the first use. Tile data
+# is cast to BLOB because some tools store JSON tiles as TEXT, which apsw
+# would return as str rather than bytes.
+_SELECT_TILE_SQL = 'SELECT CAST(tile_data AS BLOB) FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
+_REPLACE_TILE_SQL = 'REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)'
+_REPLACE_ZEROBLOB_SQL = 'REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, zeroblob(?))'
+_DELETE_TILE_SQL = 'DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
+
+# Tiles at least this large are written into a zeroblob through incremental
+# blob I/O instead of being bound whole, where the connection has blobopen().
+_BLOB_STREAM_SIZE = 512 * 1024
+
+# Metadata keys returned by tileset_info(), in order.
+_INFO_KEYS = ('name', 'type', 'version', 'description', 'format', 'bounds')
+
+# Coordinates per query in get_tiles(), at three bound parameters apiece.
+_GET_TILES_CHUNK = 333
+
+# MBTiles rows count up from the south (TMS) while TileStache counts down from
+# the north, so a row is flipped with ((1 << zoom) - 1) - row. Hello, Paul Ramsey.
+# The flip is done here rather than in SQL so that lookups match tile_row
+# directly and use the coord index, which tilesets made elsewhere also have.
+
+# Tileset format from metadata to mime-type, and mime-type to response format.
+_FORMATS = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'json': 'application/json',
+    'pbf': 'application/x-protobuf',
+    None: None
+}
+
+# File extension to mime-type and format, for getTypeByExtension().
+_EXTENSIONS = {
+    'json': ('application/json', 'JSON'),
+    'png': ('image/png', 'PNG'),
+    'jpg': ('image/jpg', 'JPEG'),
+    'pbf': ('application/x-protobuf', 'pbf')
+}
+
+_PIL_FORMATS = {
+    'image/png': 'png',
+    'image/jpeg': 'jpg',
+    'application/json': 'json',
+    'application/x-protobuf': 'pbf',
+    None: None
+}
+
+class _APSWConnection:
+    """ Wrapper for an apsw connection with the parts of the sqlite3 interface used here.
+
+        Like sqlite3, a transaction is started before statements that change
+        data, and lasts until commit().
+    """
+    def __init__(self, filename):
+        self.db = apsw.Connection(filename, statementcachesize=256)
+        self.db.setbusytimeout(5000)
+
+    def execute(self, sql, params=()):
+        self._begin(sql)
+        return _APSWCursor(self.db, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        self._begin(sql)
+        self.db.cursor().executemany(sql, seq_of_params)
+
+    def executescript(self, sql):
+        self.db.cursor().execute(sql)
+
+    def commit(self):
+        if not self.db.getautocommit():
+            self.db.cursor().execute('COMMIT')
+
+    def rollback(self):
+        if not self.db.getautocommit():
+            self.db.cursor().execute('ROLLBACK')
+
+    def close(self):
+        self.db.close()
+
+    def blobopen(self, table, column, rowid):
+        return self.db.blobopen('main', table, column, rowid, True)
+
+    def _begin(self, sql):
+        if self.db.getautocommit() and sql[:7].upper() in ('INSERT ', 'REPLACE', 'DELETE ', 'UPDATE '):
+            self.db.cursor().execute('BEGIN')
+
+class _APSWCursor:
+    """ Results of one apsw statement, read like a sqlite3 cursor.
+    """
+    arraysize = 1
+
+    def __init__(self, db, sql, params):
+        self.rows = db.cursor().execute(sql, params)
+        self.lastrowid = db.last_insert_rowid()
+
+    def __iter__(self):
+        return self.rows
+
+    def fetchone(self):
+        return next(self.rows, None)
+
+    def fetchmany(self):
+        return list(islice(self.rows, self.arraysize))
+
+def _open(filename, readonly):
+    """ Open a connection to a tileset with tuned PRAGMAs.
+
+        Write connections give new files a larger page size, and read
+        connections are made query-only. Neither changes the journal mode of
+        the file; only Cache switches a tileset to WAL mode while it's open.
+
+        Uses apsw if it's installed, and the sqlite3 module otherwise.
+    """
+    if apsw is not None:
+        db = _APSWConnection(filename)
+    else:
+        db = _connect(filename, check_same_thread=False, cached_statements=256)
+        db.text_factory = bytes
+
+    if readonly:
+        db.execute('PRAGMA query_only=1')
+    else:
+        # page_size only has an effect on a new, empty database file.
+        db.execute('PRAGMA page_size=8192')
+
+    db.execute('PRAGMA temp_store=MEMORY')
+    db.execute('PRAGMA cache_size=-65536')
+    db.execute('PRAGMA mmap_size=268435456')
+
+    return db
+
+def _get_db(filename):
+    """ Return this thread's read-only connection to a tileset.
+
+        The connection is opened on first use and reused after that.
+    """
+    try:
+        conns = _pool.conns
+    except AttributeError:
+        conns = _pool.conns = {}
+
+    if filename not in conns:
+        conns[filename] = _open(filename, True)
+
+    return conns[filename]
+
+def _get_writer(filename):
+    """ Return the shared write connection to a tileset.
+
+        Callers must hold _write_lock while using it.
+    """
+    if filename not in _writers:
+        _writers[filename] = _open(filename, False)
+
+    return _writers[filename]
+
+def _close_writer(filename):
+    """ Checkpoint and close the shared write connection to a tileset, if open.
+
+        The tileset is switched back out of WAL mode so that it's a single
+        portable file again. That needs every other connection to be closed,
+        so this thread's reader goes too; if other threads still hold readers
+        the tileset is left checkpointed but in WAL mode.
+    """
+    with _write_lock:
+        db = _writers.pop(filename, None)
+
+        if db is None:
+            return
+
+        reader = getattr(_pool, 'conns', {}).pop(filename, None)
+
+        if reader is not None:
+            reader.close()
+
+        try:
+            db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+            try:
+                db.execute('PRAGMA journal_mode=DELETE')
+            except Exception:
+                # another connection still has the tileset open
+                pass
+        finally:
+            db.close()
+
 def create_tileset(filename, name, type, version, description, format, bounds=None):
     """ Create a tileset 1.1 with the given filename and metadata.
 
@@ -79,41 +296,107 @@ def create_tileset(filename, name, type, version, description, format, bounds=No
     if format not in ('png', 'jpg', 'json', 'pbf'):
         raise Exception('Format must be one of "png", "jpg", "json" or "pbf", not "%s"' % format)
 
-    db = _connect(filename)
-
-    db.execute('CREATE TABLE metadata (name TEXT, value TEXT, PRIMARY KEY (name))')
-    db.execute('CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
-    db.execute('CREATE UNIQUE INDEX coord ON tiles (zoom_level, tile_column, tile_row)')
-
-    db.execute('INSERT INTO metadata VALUES (?, ?)', ('name', name))
-    db.execute('INSERT INTO metadata VALUES (?, ?)', ('type', type))
-    db.execute('INSERT INTO metadata VALUES (?, ?)', ('version', version))
-    db.execute('INSERT INTO metadata VALUES (?, ?)', ('description', description))
-    db.execute('INSERT INTO metadata VALUES (?, ?)', ('format', format))
+    with _write_lock:
+        _create_tileset(_get_writer(filename), name, type, version, description, format, bounds)
 
-    if bounds is not None:
-        db.execute('INSERT INTO metadata VALUES (?, ?)', ('bounds', bounds))
+def _create_tileset(db, name, type, version, description, format, bounds):
+    """ Create tileset tables and metadata using an open connection.
+    """
+    try:
+        # page_size has to come before the first table. There's no BEGIN in the
+        # script, because Python 2's sqlite3 opens its own transaction for the
+        # metadata rows and would refuse to start one inside ours.
+        db.executescript('''
+            PRAGMA page_size=8192;
+            CREATE TABLE metadata (name TEXT, value TEXT, PRIMARY KEY (name));
+            CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+            CREATE UNIQUE INDEX coord ON tiles (zoom_level, tile_column, tile_row);
+            ''')
+
+        rows = [('name', name), ('type', type), ('version', version),
+                ('description', description), ('format', format)]
+
+        if bounds is not None:
+            rows.append(('bounds', bounds))
+
+        db.executemany('INSERT INTO metadata VALUES (?, ?)', rows)
+        db.commit()
+    except:
+        db.rollback()
+        raise
+
+def finalize_tileset(filename):
+    """ Fill in minzoom, maxzoom, bounds and center metadata from the tiles present.
+
+        Readers of the tileset can then look these up instead of scanning
+        the tiles table. Zoom levels and center are recomputed every time,
+        so they follow tiles added later. Bounds cover the tiles at every
+        zoom level, but bounds already in the metadata are left alone; center
+        is placed in the middle of the tiles at the lowest zoom level. Does
+        nothing if the tileset has no tiles.
+    """
+    with _write_lock:
+        _finalize_tileset(_get_writer(filename))
 
-    db.commit()
-    db.close()
+def _finalize_tileset(db):
+    """ Fill in minzoom, maxzoom, bounds and center metadata using an open connection.
+    """
+    try:
+        q = 'SELECT zoom_level, MIN(tile_column), MAX(tile_column), MIN(tile_row), MAX(tile_row) ' \
+            'FROM tiles GROUP BY zoom_level'
+        levels = list(db.execute(q))
+
+        if not levels:
+            return
+
+        west, south, east, north = 180, 90, -180, -90
+
+        # Tile edges to longitude and latitude in spherical mercator; tile_row
+        # counts up from the south, so the top edge of the northernmost tile
+        # is one row above it.
+        for (zoom, xmin, xmax, ymin, ymax) in levels:
+            size = float(1 << zoom)
+            west = min(west, xmin / size * 360 - 180)
+            east = max(east, (xmax + 1) / size * 360 - 180)
+            south = min(south, degrees(atan(sinh(pi * (2 * ymin / size - 1)))))
+            north = max(north, degrees(atan(sinh(pi * (2 * (ymax + 1) / size - 1)))))
+
+        minzoom = min(zoom for (zoom, _, _, _, _) in levels)
+        maxzoom = max(zoom for (zoom, _, _, _, _) in levels)
+
+        rows = [('minzoom', str(minzoom)), ('maxzoom', str(maxzoom)),
+                ('center', '%.6f,%.6f,%d' % ((west + east) / 2, (south + north) / 2, minzoom))]
+
+        if db.execute("SELECT 1 FROM metadata WHERE name='bounds'").fetchone() is None:
+            rows.append(('bounds', '%.6f,%.6f,%.6f,%.6f' % (west, south, east, north)))
+
+        # Delete and insert rather than REPLACE, since metadata tables made
+        # by other tools don't always have a primary key on name.
+        db.execute("DELETE FROM metadata WHERE name IN ('minzoom', 'maxzoom', 'center')")
+        db.executemany('INSERT INTO metadata VALUES (?, ?)', rows)
+        db.commit()
+    except:
+        db.rollback()
+        raise
 
 def tileset_exists(filename):
     """ Return true if the tileset exists and appears to have the right tables.
+
+        Tables are checked in the schema rather than by querying them, and
+        views count too since some tilesets define tiles as a view.
     """
     if not exists(filename):
         return False
 
-    # this always works
-    db = _connect(filename)
-    db.text_factory = bytes
-
     try:
-        db.execute('SELECT name, value FROM metadata LIMIT 1')
-        db.execute('SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles LIMIT 1')
+        db = _get_db(filename)
+        q = "SELECT name FROM sqlite_master WHERE type IN ('table', 'view') AND name IN ('metadata', 'tiles')"
+        names = set(name for (name, ) in db.execute(q))
     except:
+        # not a SQLite database at all
         return False
 
-    return True
+    return len(names) == 2
 
 def tileset_info(filename):
     """ Return name, type, version, description, format, and bounds for a tileset.
@@ -123,78 +406,168 @@ def tileset_info(filename):
     if not tileset_exists(filename):
         return None
 
-    db = _connect(filename)
-    db.text_factory = bytes
+    db = _get_db(filename)
+    rows = db.execute('SELECT name, value FROM metadata WHERE name IN (?, ?, ?, ?, ?, ?)', _INFO_KEYS)
 
-    info = []
+    values = dict((_text(name), _text(value)) for (name, value) in rows)
 
-    for key in ('name', 'type', 'version', 'description', 'format', 'bounds'):
-        value = db.execute('SELECT value FROM metadata WHERE name = ?', (key, )).fetchone()
-        info.append(value and value[0] or None)
-
-    return info
+    return [values.get(key) for key in _INFO_KEYS]
 
 def list_tiles(filename):
     """ Get a list of tile coordinates.
     """
-    db = _connect(filename)
-    db.text_factory = bytes
+    return list(iter_tiles(filename))
+
+def iter_tiles(filename):
+    """ Generate tile coordinates, without holding them all in memory.
+
+        Only the columns of the coord index are selected, so SQLite can
+        answer from the index alone and never read pages of tile data.
+    """
+    tiles = _get_db(filename).execute('SELECT zoom_level, tile_column, tile_row FROM tiles')
+    tiles.arraysize = 8192
+
+    while True:
+        rows = tiles.fetchmany()
 
-    tiles = db.execute('SELECT tile_row, tile_column, zoom_level FROM tiles')
-    tiles = (((2**z - 1) - y, x, z) for (y, x, z) in tiles) # Hello, Paul Ramsey.
-    tiles = [Coordinate(row, column, zoom) for (row, column, zoom) in tiles]
+        if not rows:
+            return
 
-    return tiles
+        for (z, x, y) in rows:
+            yield Coordinate(((1 << z) - 1) - y, x, z)
 
 def get_tile(filename, coord):
     """ Retrieve the mime-type and raw content of a tile by coordinate.
 
         If the tile does not exist, None is returned for the content.
     """
-    db = _connect(filename)
-    db.text_factory = bytes
-
-    formats = {
-        'png': 'image/png',
-        'jpg': 'image/jpeg',
-        'json': 'application/json',
-        'pbf': 'application/x-protobuf',
-        None: None
-    }
+    db = _get_db(filename)
 
-    format = db.execute("SELECT value FROM metadata WHERE name='format'").fetchone()
-    format = format and format[0] or None
-    mime_type = formats[format]
+    return _get_format(db), _get_tile_content(db, coord)
 
-    tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
-    q = 'SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
-    content = db.execute(q, (coord.zoom, coord.column, tile_row)).fetchone()
-    content = content and content[0] or None
+def get_tiles(filename, coords):
+    """ Retrieve the raw content of many tiles by coordinate.
 
-    return mime_type, content
+        Returns a list of contents in the same order as coords, with None
+        for tiles that do not exist.
+    """
+    return _get_tiles_content(_get_db(filename), coords)
 
 def delete_tile(filename, coord):
     """ Delete a tile by coordinate.
     """
-    db = _connect(filename)
-    db.text_factory = bytes
+    delete_tiles(filename, [coord])
 
-    tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
-    q = 'DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
-    db.execute(q, (coord.zoom, coord.column, tile_row))
+def delete_tiles(filename, coords):
+    """ Delete a sequence of tiles by coordinate in one transaction.
+    """
+    with _write_lock:
+        _delete_tiles(_get_writer(filename), coords)
 
 def put_tile(filename, coord, content):
+    """ Write a tile by coordinate.
+    """
+    put_tiles(filename, [(coord, content)])
+
+def put_tiles(filename, tiles):
+    """ Write a sequence of (coordinate, content) pairs in one transaction.
+    """
+    with _write_lock:
+        _put_tiles(_get_writer(filename), tiles)
+
+def _get_format(db):
+    """ Retrieve the mime-type of a tileset's format from an open connection.
+    """
+    format = db.execute("SELECT value FROM metadata WHERE name='format'").fetchone()
+    format = _text(format[0]) if format is not None else None
+
+    return _FORMATS[format]
+
+def _text(value):
+    """ Return a metadata value as text.
+
+        sqlite3 returns text as bytes here because of text_factory, while
+        apsw always returns str, and callers shouldn't have to care which.
     """
+    if isinstance(value, bytes):
+        return value.decode('utf8')
+
+    return value
+
+def _get_tile_content(db, coord):
+    """ Retrieve the raw content of a tile from an open connection.
+    """
+    tile_row = ((1 << coord.zoom) - 1) - coord.row
+    content = db.execute(_SELECT_TILE_SQL, (coord.zoom, coord.column, tile_row)).fetchone()
+    content = content[0] if content is not None else None
+
+    return content
+
+def _get_tiles_content(db, coords):
+    """ Retrieve the raw content of many tiles from an open connection.
+
+        Coordinates are looked up a few hundred at a time with one query
+        each, staying under SQLite's default limit of 999 bound parameters.
+    """
+    keys = [(coord.zoom, coord.column, ((1 << coord.zoom) - 1) - coord.row) for coord in coords]
+    found = {}
+
+    for offset in range(0, len(keys), _GET_TILES_CHUNK):
+        chunk = keys[offset:offset + _GET_TILES_CHUNK]
+        values = ', '.join(['(?, ?, ?)'] * len(chunk))
+        params = [value for key in chunk for value in key]
+
+        q = 'WITH req (zoom_level, tile_column, tile_row) AS (VALUES %s) ' \
+            'SELECT zoom_level, tile_column, tile_row, CAST(tile_data AS BLOB) ' \
+            'FROM req JOIN tiles USING (zoom_level, tile_column, tile_row)' % values
+
+        for (z, x, y, content) in db.execute(q, params):
+            found[(z, x, y)] = content
+
+    return [found.get(key) for key in keys]
+
+def _delete_tiles(db, coords):
+    """ Delete tiles by coordinate in one transaction using an open connection.
     """
-    db = _connect(filename)
-    db.text_factory = bytes
+    try:
+        rows = [(coord.zoom, coord.column, ((1 << coord.zoom) - 1) - coord.row) for coord in coords]
 
-    tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
-    q = 'REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)'
-    db.execute(q, (coord.zoom, coord.column, tile_row, buffer(content)))
+        db.executemany(_DELETE_TILE_SQL, rows)
+        db.commit()
+    except:
+        db.rollback()
+        raise
+
+def _put_tiles(db, tiles):
+    """ Write (coordinate, content) pairs in one transaction using an open connection.
+    """
+    try:
+        rows, large = [], []
+        streaming = hasattr(db, 'blobopen')
 
-    db.commit()
-    db.close()
+        # Only the last content for each tile counts, since small and large
+        # tiles are written separately below.
+        latest = dict(((coord.zoom, coord.column, ((1 << coord.zoom) - 1) - coord.row), content)
+                      for (coord, content) in tiles)
+
+        for (key, content) in latest.items():
+            if streaming and len(content) >= _BLOB_STREAM_SIZE:
+                large.append((key, content))
+            else:
+                rows.append(key + (_blob(content), ))
+
+        db.executemany(_REPLACE_TILE_SQL, rows)
+
+        for (key, content) in large:
+            rowid = db.execute(_REPLACE_ZEROBLOB_SQL, key + (len(content), )).lastrowid
+
+            with db.blobopen('tiles', 'tile_data', rowid) as blob:
+                blob.write(content)
+
+        db.commit()
+    except:
+        db.rollback()
+        raise
 
 class Provider:
     """ MBTiles provider.
@@ -213,6 +586,13 @@ class Provider:
         self.tileset = path
         self.layer = layer
 
+        # The format can't change for the life of the tileset, so it's looked
+        # up once, on the first tile. Opening the tileset here would fail the
+        # whole configuration over one bad path, and would share a connection
+        # with any worker processes forked after configuration is loaded.
+        self.mime_type, self.tile_format = None, None
+        self._has_format = False
+
     @staticmethod
     def prepareKeywordArgs(config_dict):
         """ Convert configured parameters to keyword args for __init__().
@@ -222,34 +602,25 @@ class Provider:
     def renderTile(self, width, height, srs, coord):
         """ Retrieve a single tile, return a TileResponse instance.
         """
-        mime_type, content = get_tile(self.tileset, coord)
-        formats = {
-            'image/png': 'png',
-            'image/jpeg': 'jpg',
-            'application/json': 'json',
-            'application/x-protobuf': 'pbf',
-            None: None
-        }
-        return TileResponse(formats[mime_type], content)
+        if not self._has_format:
+            if not tileset_exists(self.tileset):
+                raise KnownUnknown('MBTiles tileset "%s" does not exist or is missing tables' % self.tileset)
+
+            self.mime_type = _get_format(_get_db(self.tileset))
+            self.tile_format = _PIL_FORMATS[self.mime_type]
+            self._has_format = True
+
+        content = _get_tile_content(_get_db(self.tileset), coord)
+        return TileResponse(self.tile_format, content)
 
     def getTypeByExtension(self, extension):
         """ Get MIME-type and format by file extension.
 
             This only accepts "png", "jpg", "json" or "pbf".
         """
-        if extension.lower() == 'json':
-            return 'application/json', 'JSON'
-
-        elif extension.lower() == 'png':
-            return 'image/png', 'PNG'
-
-        elif extension.lower() == 'jpg':
-            return 'image/jpg', 'JPEG'
-
-        elif extension.lower() == 'pbf':
-            return 'application/x-protobuf', 'pbf'
-
-        else:
+        try:
+            return _EXTENSIONS[extension.lower()]
+        except KeyError:
             raise KnownUnknown('MBTiles only makes .png, .jpg, .json and .pbf tiles, not "%s"' % extension)
 
 class TileResponse:
@@ -269,6 +640,9 @@ class TileResponse:
         if self.format is not None and format.lower() != self.format.lower():
             raise Exception('Requested format "%s" does not match tileset format "%s"' % (format, self.format))
 
+        # Content is the tile_data value as read, written in one call. Callers
+        # copy it out of their buffer afterwards, so streaming it from a blob
+        # handle instead would only add a rowid lookup.
         out.write(self.content)
 
 class Cache:
@@ -280,15 +654,35 @@ class Cache:
         Instead, this cache provider is provided for use with the script
         tilestache-seed.py, which can be called with --to-mbtiles option
         to write cached tiles to a new tileset.
+
+        Saved tiles are handed to a background writer thread, which writes
+        them up to batch_size at a time in a single transaction so that
+        rendering doesn't wait on the disk. Call close() when done to make
+        sure everything has been written and zoom and bounds metadata are
+        filled in.
     """
-    def __init__(self, filename, format, name):
+    def __init__(self, filename, format, name, batch_size=256):
         """
         """
         self.filename = filename
+        self.batch_size = batch_size
 
         if not tileset_exists(filename):
             create_tileset(filename, name, 'baselayer', '0', '', format.lower())
 
+        # WAL with relaxed syncing lets reads go on during batch writes, and
+        # close() puts the tileset back into a single portable file.
+        with _write_lock:
+            db = _get_writer(filename)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+
+        self._writer = _CacheWriter(filename, batch_size)
+
+        # Neither the writer thread nor this exit hook holds on to the Cache,
+        # so one dropped without close() is freed and its tiles still written.
+        atexit.register(_close_at_exit, self._writer)
+
     def lock(self, layer, coord, format):
         return
 
@@ -298,14 +692,159 @@ class Cache:
     def remove(self, layer, coord, format):
         """ Remove a cached tile.
         """
+        self.flush()
         delete_tile(self.filename, coord)
 
     def read(self, layer, coord, format):
         """ Return raw tile content from tileset.
         """
-        return get_tile(self.filename, coord)[1]
+        body = self._writer.get(coord)
+
+        if body is not None:
+            return body
+
+        return _get_tile_content(_get_db(self.filename), coord)
 
     def save(self, body, layer, coord, format):
         """ Write raw tile content to tileset.
+
+            Once a batch of tiles has failed to be written, this and every
+            later call raises that error, rather than carrying on saving
+            tiles as if nothing had happened. Raises an exception after
+            close() too.
+        """
+        self._writer.put(coord, body)
+
+    def flush(self):
+        """ Wait until all saved tiles have been written to the tileset.
+        """
+        self._writer.flush()
+
+    def close(self):
+        """ Write any remaining tiles, stop the writer thread and finalize.
+
+            Call this when finished saving. Raises the first error from
+            writing tiles, if there was one.
+        """
+        self._writer.close()
+
+class _CacheWriter:
+    """ Background thread writing tiles saved to a Cache into its tileset.
+
+        Tiles are written up to batch_size at a time in a single transaction.
+        The first error from writing is kept and raised from every call after.
+    """
+    def __init__(self, filename, batch_size):
+        self.filename = filename
+        self.batch_size = batch_size
+
+        # Tiles saved but not yet written, so reads can still find them.
+        self.pending = {}
+        self.pending_lock = Lock()
+
+        self.error = None
+        self.closed = False
+
+        self.queue = Queue(maxsize=4 * batch_size)
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get(self, coord):
+        """ Return saved content for a tile that hasn't been written yet, or None.
         """
-        put_tile(self.filename, coord, body)
+        with self.pending_lock:
+            return self.pending.get((coord.zoom, coord.column, coord.row))
+
+    def put(self, coord, body):
+        """ Queue a tile to be written.
+        """
+        self.check()
+
+        with self.pending_lock:
+            self.pending[(coord.zoom, coord.column, coord.row)] = body
+
+        self.queue.put((coord, body))
+
+    def flush(self):
+        """ Wait until all queued tiles have been written.
+        """
+        self.check()
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        """ Write queued tiles, stop the thread and finalize the tileset.
+
+            Finalizing is skipped if any tiles failed to be written.
+        """
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
+
+            try:
+                if self.error is None:
+                    finalize_tileset(self.filename)
+            except Exception as e:
+                self.error = e
+            finally:
+                _close_writer(self.filename)
+
+        if self.error is not None:
+            raise self.error
+
+    def check(self):
+        """ Raise the error from writing tiles if there was one, or if closed.
+        """
+        if self.error is not None:
+            raise self.error
+
+        if self.closed:
+            raise Exception('MBTiles cache for "%s" has already been closed' % self.filename)
+
+    def run(self):
+        """ Write queued tiles in batches until close() sends None.
+        """
+        while True:
+            items = [self.queue.get()]
+
+            while len(items) < self.batch_size and items[-1] is not None:
+                try:
+                    items.append(self.queue.get_nowait())
+                except Empty:
+                    break
+
+            tiles = [item for item in items if item is not None]
+
+            try:
+                if tiles:
+                    put_tiles(self.filename, tiles)
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+            finally:
+                with self.pending_lock:
+                    for (coord, body) in tiles:
+                        key = coord.zoom, coord.column, coord.row
+
+                        # A newer save of the same tile may still be queued.
+                        if self.pending.get(key) is body:
+                            del self.pending[key]
+
+                for item in items:
+                    self.queue.task_done()
+
+            if items[-1] is None:
+                return
+
+def _close_at_exit(writer):
+    """ Close a Cache writer still open when the interpreter exits, logging any error.
+    """
+    if writer.closed:
+        return
+
+    try:
+        writer.close()
+    except Exception:
+        logging.exception('TileStache.MBTiles.Cache failed to close %s', writer.filename)
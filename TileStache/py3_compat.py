@@ -20,6 +20,7 @@ try:
     import http.client as httplib
     from urllib.parse import urlparse, urljoin, parse_qsl
     from urllib.request import urlopen
+    from queue import Queue, Empty
     from cgi import parse_qs
     from _thread import allocate_lock
     unichr = chr
@@ -29,5 +30,6 @@ except ImportError:
     import urllib2
     from urlparse import urlparse, urljoin, parse_qs, parse_qsl
     from urllib import urlopen
+    from Queue import Queue, Empty
     from thread import allocate_lock
     unichr = unichr
@@ -99,7 +99,7 @@ if __name__ == '__main__':
     options, zooms = parser.parse_args()
 
     if bool(options.mbtiles_input):
-        coordinates = MBTiles.list_tiles(options.mbtiles_input)
+        coordinates = MBTiles.iter_tiles(options.mbtiles_input)
 
     else:
         lat1, lon1, lat2, lon2 = options.bbox
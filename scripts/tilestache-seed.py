@@ -398,3 +398,11 @@ if __name__ == '__main__':
             fp = open(options.progressfile, 'w')
             json_dump(progress, fp)
             fp.close()
+
+    #
+    # Write out anything still buffered by caches, e.g. the MBTiles cache,
+    # which also fills in its zoom and bounds metadata on close.
+    #
+    for cache in getattr(config.cache, 'tiers', [config.cache]):
+        if hasattr(cache, 'close'):
+            cache.close()
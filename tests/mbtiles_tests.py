@@ -0,0 +1,405 @@
+import os
+import gc
+import sqlite3
+import weakref
+from io import BytesIO
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from ModestMaps.Core import Coordinate
+from TileStache import MBTiles, parseConfig
+from TileStache.Core import KnownUnknown
+
+def as_bytes(content):
+    ''' Python 2's sqlite3 returns tile data as buffers, so compare it as bytes.
+    '''
+    return None if content is None else bytes(content)
+
+class MBTilesTests(TestCase):
+    '''Tests MBTiles tileset functions and Cache, with the default database module'''
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-mbtiles-')
+        self.filename = os.path.join(self.tmpdir, 'test.mbtiles')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def get_provider(self):
+        config = parseConfig({
+            'cache': {'name': 'Test'},
+            'layers': {'tiles': {'provider': {'name': 'mbtiles', 'tileset': self.filename}}}
+            })
+
+        return config.layers['tiles'].provider
+
+    def test_create_tileset(self):
+        '''create_tileset makes the tables, metadata and page size in a new file'''
+
+        MBTiles.create_tileset(self.filename, 'test', 'baselayer', '0', 'Tiles', 'png', '1,2,3,4')
+        MBTiles.put_tile(self.filename, Coordinate(0, 0, 0), b'a')
+
+        db = sqlite3.connect(self.filename)
+        self.assertEqual(db.execute('PRAGMA page_size').fetchone()[0], 8192)
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM tiles').fetchone()[0], 1)
+        db.close()
+
+        self.assertEqual(MBTiles.tileset_info(self.filename), ['test', 'baselayer', '0', 'Tiles', 'png', '1,2,3,4'])
+
+    def test_create_tileset_twice(self):
+        '''create_tileset fails on an existing tileset and leaves it usable'''
+
+        MBTiles.create_tileset(self.filename, 'test', 'baselayer', '0', '', 'png')
+        self.assertRaises(Exception, MBTiles.create_tileset, self.filename, 'again', 'overlay', '1', '', 'jpg')
+
+        MBTiles.put_tile(self.filename, Coordinate(0, 0, 0), b'a')
+
+        self.assertEqual(MBTiles.tileset_info(self.filename), ['test', 'baselayer', '0', '', 'png', None])
+        self.assertEqual(as_bytes(MBTiles.get_tile(self.filename, Coordinate(0, 0, 0))[1]), b'a')
+
+    def test_put_tile_keeps_journal_mode(self):
+        '''Writing through the tileset functions leaves a rollback journal file'''
+
+        MBTiles.create_tileset(self.filename, 'test', 'baselayer', '0', '', 'png')
+        MBTiles.put_tile(self.filename, Coordinate(0, 0, 0), b'a')
+
+        db = sqlite3.connect(self.filename)
+        self.assertEqual(db.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+        db.close()
+
+        self.assertFalse(os.path.exists(self.filename + '-wal'))
+
+    def test_empty_values(self):
+        '''Empty tiles and descriptions read back as empty, not None'''
+
+        MBTiles.create_tileset(self.filename, 'test', 'baselayer', '0', '', 'png')
+        MBTiles.put_tile(self.filename, Coordinate(0, 0, 0), b'')
+
+        self.assertEqual(MBTiles.tileset_info(self.filename)[3], '')
+        self.assertEqual(as_bytes(MBTiles.get_tile(self.filename, Coordinate(0, 0, 0))[1]), b'')
+        self.assertEqual([as_bytes(c) for c in MBTiles.get_tiles(self.filename, [Coordinate(0, 0, 0)])], [b''])
+
+    def test_tileset_info(self):
+        '''tileset_info returns values in order, with None for missing keys'''
+
+        self.assertEqual(MBTiles.tileset_info(self.filename), None)
+
+        MBTiles.create_tileset(self.filename, 'test', 'overlay', '1', 'Tiles', 'jpg')
+
+        db = sqlite3.connect(self.filename)
+        db.execute("INSERT INTO metadata VALUES ('attribution', 'Someone')")
+        db.commit()
+        db.close()
+
+        self.assertEqual(MBTiles.tileset_info(self.filename), ['test', 'overlay', '1', 'Tiles', 'jpg', None])
+
+    def test_tileset_exists(self):
+        '''tileset_exists accepts a tiles view and rejects files that aren't tilesets'''
+
+        with open(self.filename, 'wb') as file:
+            file.write(b'This is not a SQLite database, though it is long enough to look like one.' * 16)
+
+        self.assertFalse(MBTiles.tileset_exists(self.filename))
+
+        filename = os.path.join(self.tmpdir, 'view.mbtiles')
+        db = sqlite3.connect(filename)
+        db.executescript('''
+            CREATE TABLE metadata (name TEXT, value TEXT);
+            CREATE TABLE map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT);
+            CREATE TABLE images (tile_id TEXT, tile_data BLOB);
+            CREATE VIEW tiles AS SELECT zoom_level, tile_column, tile_row, tile_data
+                FROM map JOIN images USING (tile_id);
+            ''')
+        db.close()
+
+        self.assertTrue(MBTiles.tileset_exists(filename))
+        self.assertFalse(MBTiles.tileset_exists(os.path.join(self.tmpdir, 'missing.mbtiles')))
+
+    def test_cache_read_before_flush(self):
+        '''Saved tiles can be read back before the writer has written them'''
+
+        cache = MBTiles.Cache(self.filename, 'png', 'test')
+        cache.save(b'tile', None, Coordinate(1, 2, 3), 'PNG')
+
+        self.assertEqual(as_bytes(cache.read(None, Coordinate(1, 2, 3), 'PNG')), b'tile')
+        cache.close()
+
+    def test_cache_remove_after_queued_save(self):
+        '''A removed tile stays removed even if its save was still queued'''
+
+        cache = MBTiles.Cache(self.filename, 'png', 'test')
+        cache.save(b'tile', None, Coordinate(1, 2, 3), 'PNG')
+        cache.remove(None, Coordinate(1, 2, 3), 'PNG')
+        cache.close()
+
+        self.assertEqual(MBTiles.get_tile(self.filename, Coordinate(1, 2, 3)), ('image/png', None))
+
+    def test_cache_close_writes_everything(self):
+        '''Closing a cache writes every saved tile to a single tileset file'''
+
+        cache = MBTiles.Cache(self.filename, 'png', 'test', batch_size=16)
+        coords = [Coordinate(row, column, 5) for row in range(10) for column in range(10)]
+
+        for coord in coords:
+            cache.save(('%d/%d' % (coord.column, coord.row)).encode('ascii'), None, coord, 'PNG')
+
+        cache.close()
+
+        self.assertFalse(os.path.exists(self.filename + '-wal'))
+
+        listed = sorted((c.zoom, c.column, c.row) for c in MBTiles.list_tiles(self.filename))
+        self.assertEqual(listed, sorted((c.zoom, c.column, c.row) for c in coords))
+        self.assertEqual(as_bytes(MBTiles.get_tile(self.filename, Coordinate(3, 7, 5))[1]), b'7/3')
+
+    def test_cache_write_errors_are_sticky(self):
+        '''Once tiles fail to be written, every later save, flush and close raises'''
+
+        cache = MBTiles.Cache(self.filename, 'png', 'test', batch_size=4)
+        put_tiles = MBTiles.put_tiles
+
+        def fail_once(filename, tiles):
+            MBTiles.put_tiles = put_tiles
+            raise IOError('Disk is full')
+
+        MBTiles.put_tiles = fail_once
+
+        try:
+            for column in range(4):
+                cache.save(b'tile', None, Coordinate(0, column, 2), 'PNG')
+
+            self.assertRaises(IOError, cache.flush)
+        finally:
+            MBTiles.put_tiles = put_tiles
+
+        self.assertRaises(IOError, cache.save, b'tile', None, Coordinate(1, 0, 2), 'PNG')
+        self.assertRaises(IOError, cache.flush)
+        self.assertRaises(IOError, cache.close)
+        self.assertRaises(IOError, cache.close)
+
+    def test_cache_closed(self):
+        '''Saving to a closed cache raises instead of queueing tiles nobody writes'''
+
+        cache = MBTiles.Cache(self.filename, 'png', 'test')
+        cache.close()
+
+        self.assertRaises(Exception, cache.save, b'tile', None, Coordinate(1, 2, 3), 'PNG')
+        self.assertRaises(Exception, cache.flush)
+        self.assertRaises(Exception, cache.remove, None, Coordinate(1, 2, 3), 'PNG')
+        cache.close()
+
+        self.assertEqual(MBTiles.list_tiles(self.filename), [])
+
+    def test_cache_freed_without_close(self):
+        '''A cache dropped without close() is freed, and its writer still writes its tiles'''
+
+        cache = MBTiles.Cache(self.filename, 'png', 'test')
+        cache.save(b'tile', None, Coordinate(1, 2, 3), 'PNG')
+
+        writer, cache_ref = cache._writer, weakref.ref(cache)
+        del cache
+        gc.collect()
+
+        self.assertEqual(cache_ref(), None)
+
+        # what the exit hook would do
+        writer.close()
+        self.assertEqual(as_bytes(MBTiles.get_tile(self.filename, Coordinate(1, 2, 3))[1]), b'tile')
+
+    def test_get_tiles_order_and_missing(self):
+        '''get_tiles returns contents in request order, with None for missing tiles'''
+
+        MBTiles.create_tileset(self.filename, 'test', 'baselayer', '0', '', 'png')
+        MBTiles.put_tiles(self.filename, [(Coordinate(0, 0, 1), b'a'), (Coordinate(1, 1, 1), b'b')])
+
+        coords = [Coordinate(1, 1, 1), Coordinate(0, 1, 1), Coordinate(0, 0, 1), Coordinate(1, 1, 1)]
+        self.assertEqual([as_bytes(c) for c in MBTiles.get_tiles(self.filename, coords)], [b'b', None, b'a', b'b'])
+
+        MBTiles.delete_tiles(self.filename, [Coordinate(0, 0, 1)])
+        self.assertEqual([as_bytes(c) for c in MBTiles.get_tiles(self.filename, coords)], [b'b', None, None, b'b'])
+
+    def test_put_large_tiles(self):
+        '''Tiles of a megabyte are written whole, replace and are replaced by small ones'''
+
+        MBTiles.create_tileset(self.filename, 'test', 'baselayer', '0', '', 'png')
+        large1, large2, small = b'1' * 1024 * 1024, b'2' * 1024 * 1024, b'small'
+        coord1, coord2 = Coordinate(0, 0, 1), Coordinate(1, 1, 1)
+
+        MBTiles.put_tiles(self.filename, [(coord1, large1), (coord2, small)])
+        self.assertEqual([as_bytes(c) for c in MBTiles.get_tiles(self.filename, [coord1, coord2])], [large1, small])
+
+        MBTiles.put_tiles(self.filename, [(coord1, small), (coord2, large2)])
+        self.assertEqual([as_bytes(c) for c in MBTiles.get_tiles(self.filename, [coord1, coord2])], [small, large2])
+
+        # the last of several contents for one tile in a batch wins
+        MBTiles.put_tiles(self.filename, [(coord1, large1), (coord1, small), (coord2, small), (coord2, large1)])
+        self.assertEqual([as_bytes(c) for c in MBTiles.get_tiles(self.filename, [coord1, coord2])], [small, large1])
+        self.assertEqual(len(MBTiles.list_tiles(self.filename)), 2)
+
+    def test_get_tiles_many(self):
+        '''get_tiles finds tiles across more than one query'''
+
+        MBTiles.create_tileset(self.filename, 'test', 'baselayer', '0', '', 'png')
+        coords = [Coordinate(row, column, 5) for row in range(32) for column in range(32)]
+        MBTiles.put_tiles(self.filename, [(coord, b'tile') for coord in coords[::2]])
+
+        found = MBTiles.get_tiles(self.filename, coords)
+        self.assertEqual([as_bytes(c) for c in found], [b'tile', None] * 512)
+
+    def test_delete_tiles_rolled_back(self):
+        '''A failed delete_tiles deletes nothing, even after a later write'''
+
+        MBTiles.create_tileset(self.filename, 'test', 'baselayer', '0', '', 'png')
+        MBTiles.put_tiles(self.filename, [(Coordinate(0, 0, 1), b'a'), (Coordinate(1, 1, 1), b'b')])
+
+        db = sqlite3.connect(self.filename)
+        db.execute("CREATE TRIGGER keep_b BEFORE DELETE ON tiles WHEN old.tile_column=1 BEGIN SELECT RAISE(ABORT, 'Keep b'); END")
+        db.commit()
+        db.close()
+
+        self.assertRaises(Exception, MBTiles.delete_tiles, self.filename, [Coordinate(0, 0, 1), Coordinate(1, 1, 1)])
+        MBTiles.put_tile(self.filename, Coordinate(0, 1, 1), b'c')
+
+        coords = [Coordinate(0, 0, 1), Coordinate(1, 1, 1), Coordinate(0, 1, 1)]
+        self.assertEqual([as_bytes(c) for c in MBTiles.get_tiles(self.filename, coords)], [b'a', b'b', b'c'])
+
+    def test_iter_tiles(self):
+        '''iter_tiles flips rows back from TMS to TileStache coordinates'''
+
+        MBTiles.create_tileset(self.filename, 'test', 'baselayer', '0', '', 'png')
+        MBTiles.put_tile(self.filename, Coordinate(1, 2, 2), b'a')
+
+        listed = [(c.zoom, c.column, c.row) for c in MBTiles.iter_tiles(self.filename)]
+        self.assertEqual(listed, [(2, 2, 1)])
+
+    def test_iter_tiles_many(self):
+        '''iter_tiles generates every tile when there are more than one fetch of them'''
+
+        MBTiles.create_tileset(self.filename, 'test', 'baselayer', '0', '', 'png')
+        coords = [Coordinate(row, column, 7) for row in range(128) for column in range(72)]
+        MBTiles.put_tiles(self.filename, [(coord, b'') for coord in coords])
+
+        tiles = MBTiles.iter_tiles(self.filename)
+        self.assertEqual(next(tiles).zoom, 7)
+
+        listed = sorted((c.zoom, c.column, c.row) for c in MBTiles.list_tiles(self.filename))
+        self.assertEqual(listed, sorted((c.zoom, c.column, c.row) for c in coords))
+
+    def test_rows_flipped_at_any_zoom(self):
+        '''Rows are flipped to and from TMS at zoom levels of 32 and above too'''
+
+        MBTiles.create_tileset(self.filename, 'test', 'baselayer', '0', '', 'png')
+        MBTiles.put_tile(self.filename, Coordinate(5, 6, 40), b'a')
+
+        db = sqlite3.connect(self.filename)
+        self.assertEqual(db.execute('SELECT tile_row FROM tiles').fetchone()[0], (1 << 40) - 1 - 5)
+        db.close()
+
+        self.assertEqual(as_bytes(MBTiles.get_tile(self.filename, Coordinate(5, 6, 40))[1]), b'a')
+        self.assertEqual([(c.zoom, c.column, c.row) for c in MBTiles.iter_tiles(self.filename)], [(40, 6, 5)])
+
+    def test_finalize_tileset(self):
+        '''finalize_tileset fills in missing zoom, bounds and center metadata'''
+
+        MBTiles.create_tileset(self.filename, 'test', 'baselayer', '0', '', 'png')
+        MBTiles.put_tiles(self.filename, [(Coordinate(0, 0, 1), b'a'), (Coordinate(1, 1, 1), b'b')])
+        MBTiles.finalize_tileset(self.filename)
+
+        db = sqlite3.connect(self.filename)
+        metadata = dict(db.execute('SELECT name, value FROM metadata'))
+        db.close()
+
+        self.assertEqual(metadata['minzoom'], '1')
+        self.assertEqual(metadata['maxzoom'], '1')
+        self.assertEqual(metadata['bounds'], '-180.000000,-85.051129,180.000000,85.051129')
+        self.assertEqual(metadata['center'], '0.000000,0.000000,1')
+
+    def test_finalize_tileset_rolled_back(self):
+        '''A failed finalize_tileset leaves the earlier metadata in place'''
+
+        MBTiles.create_tileset(self.filename, 'test', 'baselayer', '0', '', 'png')
+        MBTiles.put_tile(self.filename, Coordinate(0, 0, 1), b'a')
+        MBTiles.finalize_tileset(self.filename)
+
+        db = sqlite3.connect(self.filename)
+        db.execute("CREATE TRIGGER no_center BEFORE INSERT ON metadata WHEN new.name='center' BEGIN SELECT RAISE(ABORT, 'No center'); END")
+        db.commit()
+        db.close()
+
+        MBTiles.put_tile(self.filename, Coordinate(0, 0, 2), b'b')
+        self.assertRaises(Exception, MBTiles.finalize_tileset, self.filename)
+        MBTiles.put_tile(self.filename, Coordinate(0, 0, 3), b'c')
+
+        db = sqlite3.connect(self.filename)
+        metadata = dict(db.execute('SELECT name, value FROM metadata'))
+        db.close()
+
+        self.assertEqual((metadata['minzoom'], metadata['maxzoom']), ('1', '1'))
+        self.assertEqual(metadata['center'], '-90.000000,42.525564,1')
+
+    def test_finalize_tileset_keeps_bounds(self):
+        '''finalize_tileset leaves bounds given to create_tileset alone'''
+
+        MBTiles.create_tileset(self.filename, 'test', 'baselayer', '0', '', 'png', '1,2,3,4')
+        MBTiles.put_tile(self.filename, Coordinate(0, 0, 0), b'a')
+        MBTiles.finalize_tileset(self.filename)
+
+        self.assertEqual(MBTiles.tileset_info(self.filename)[5], '1,2,3,4')
+
+    def test_finalize_tileset_after_more_tiles(self):
+        '''finalize_tileset updates zoom and center metadata for tiles added later'''
+
+        cache = MBTiles.Cache(self.filename, 'png', 'test')
+        cache.save(b'a', None, Coordinate(0, 0, 1), 'PNG')
+        cache.close()
+
+        cache = MBTiles.Cache(self.filename, 'png', 'test')
+        cache.save(b'b', None, Coordinate(0, 0, 4), 'PNG')
+        cache.close()
+
+        db = sqlite3.connect(self.filename)
+        metadata = dict(db.execute('SELECT name, value FROM metadata'))
+        db.close()
+
+        self.assertEqual(metadata['minzoom'], '1')
+        self.assertEqual(metadata['maxzoom'], '4')
+        self.assertEqual(metadata['center'], '-90.000000,42.525564,1')
+
+    def test_get_type_by_extension(self):
+        '''Provider knows MBTiles extensions and raises KnownUnknown for others'''
+
+        provider = self.get_provider()
+
+        self.assertEqual(provider.getTypeByExtension('PNG'), ('image/png', 'PNG'))
+        self.assertEqual(provider.getTypeByExtension('pbf'), ('application/x-protobuf', 'pbf'))
+        self.assertRaises(KnownUnknown, provider.getTypeByExtension, 'gif')
+
+    def test_render_tile(self):
+        '''Provider renders tiles that save their content in the tileset format'''
+
+        MBTiles.create_tileset(self.filename, 'test', 'baselayer', '0', '', 'png')
+        MBTiles.put_tile(self.filename, Coordinate(1, 2, 3), b'tile')
+
+        provider = self.get_provider()
+
+        out = BytesIO()
+        provider.renderTile(256, 256, None, Coordinate(1, 2, 3)).save(out, 'PNG')
+        self.assertEqual(out.getvalue(), b'tile')
+
+        out = BytesIO()
+        provider.renderTile(256, 256, None, Coordinate(1, 2, 3)).save(out, 'png')
+        self.assertEqual(out.getvalue(), b'tile')
+
+        response = provider.renderTile(256, 256, None, Coordinate(1, 2, 3))
+        self.assertRaises(Exception, response.save, BytesIO(), 'JPEG')
+
+class MBTilesSQLite3Tests(MBTilesTests):
+    '''Tests MBTiles with the standard sqlite3 module, even if apsw is installed'''
+
+    def setUp(self):
+        MBTilesTests.setUp(self)
+        self.apsw, MBTiles.apsw = MBTiles.apsw, None
+
+    def tearDown(self):
+        MBTiles.apsw = self.apsw
+        MBTilesTests.tearDown(self)